@@ -47,6 +47,11 @@ resolve_service() {
         log_err "Service '${svc}' not found"
         exit 1
     fi
+    # Skip the yq parse for placeholder files with no services block
+    if [[ "$(<"$SVC_COMPOSE")" != *services:* ]]; then
+        SVC_NAMES=""
+        return 0
+    fi
     SVC_NAMES=$(yq -r '.services | keys | .[]' "$SVC_COMPOSE")
 }
 
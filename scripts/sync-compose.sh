@@ -19,21 +19,94 @@ RED=$'\033[31m'
 GREEN=$'\033[32m'
 RST=$'\033[0m'
 
+# ── Patterns ─────────────────────────────────────────────────────────────────
+# Shared include-block matchers, declared once instead of inline per loop.
+readonly RE_PATH_KEY='^[[:space:]]*-[[:space:]]*path:'
+readonly RE_ENV_KEY='^[[:space:]]*env_file:'
+readonly RE_ENV_ITEM='^[[:space:]]{4,}-[[:space:]]+(.*)$'
+readonly RE_INCLUDE_ENTRY='^  - path: services/([^/]+)/compose\.yaml$'
+
 # ── Helpers ──────────────────────────────────────────────────────────────────
 
+# Root compose.yaml cache — read from disk once, then iterate in memory.
+# Call load_compose in the parent shell before any $(make_entry ...) so the
+# subshells inherit the populated arrays.
+#   COMPOSE_LINES            — raw lines of compose.yaml
+#   INCLUDE_ENV[service]     — newline-terminated env_file entries of its include block
+#   INCLUDE_AT               — index of the 'include:' line (-1 if absent)
+COMPOSE_LINES=()
+declare -A INCLUDE_ENV=()
+INCLUDE_AT=-1
+_COMPOSE_LOADED=false
+
+load_compose() {
+    if $_COMPOSE_LOADED; then return 0; fi
+    if [[ -f "$COMPOSE" ]]; then
+        mapfile -t COMPOSE_LINES < "$COMPOSE"
+        index_compose
+    fi
+    _COMPOSE_LOADED=true
+}
+
+# Single pass over COMPOSE_LINES mapping each included service to its env_file list
+index_compose() {
+    local line svc="" in_env=false i=0
+    for line in "${COMPOSE_LINES[@]}"; do
+        if (( INCLUDE_AT < 0 )) && [[ "$line" =~ ^include: ]]; then
+            INCLUDE_AT=$i
+        fi
+        i=$((i + 1))
+
+        # Start of an include block
+        if [[ "$line" =~ ${RE_PATH_KEY}[[:space:]]*services/([^/]+)/compose\.yaml ]]; then
+            svc="${BASH_REMATCH[1]}"
+            in_env=false
+            # First block wins if a service is listed twice
+            if [[ -v INCLUDE_ENV["$svc"] ]]; then
+                svc=""
+            else
+                INCLUDE_ENV["$svc"]=""
+            fi
+            continue
+        fi
+        [[ -z "$svc" ]] && continue
+
+        # Any other path entry closes the current block
+        if [[ "$line" =~ $RE_PATH_KEY ]]; then
+            svc=""; continue
+        fi
+
+        if [[ "$line" =~ $RE_ENV_KEY ]]; then
+            in_env=true; continue
+        fi
+        if ! $in_env; then continue; fi
+
+        if [[ "$line" =~ $RE_ENV_ITEM ]]; then
+            INCLUDE_ENV["$svc"]+="${BASH_REMATCH[1]}"$'\n'
+        else
+            svc=""  # End of env_file list
+        fi
+    done
+}
+
 # Get service dirs that have a compose.yaml
+# Pathname expansion already sorts by LC_COLLATE, same as sort(1), as long as
+# the pattern has no trailing slash ("adguard/" would sort after "adguard-sync/")
 get_disk_services() {
-    for dir in "${SERVICES_DIR}"/*/; do
-        svc=$(basename "$dir")
+    for dir in "${SERVICES_DIR}"/*; do
+        svc="${dir##*/}"
         [[ "$svc" == .* ]] && continue
-        [[ -f "${dir}compose.yaml" ]] || continue
+        [[ -f "${dir}/compose.yaml" ]] || continue
         echo "$svc"
-    done | sort
+    done
 }
 
 # Get service dirs referenced in root compose.yaml include: paths
+# Read from the include index, so commented-out entries are not counted
 get_included_services() {
-    grep -oP 'path:\s*services/\K[^/]+' "$COMPOSE" | sort -u
+    load_compose
+    (( ${#INCLUDE_ENV[@]} > 0 )) || return 0
+    printf '%s\n' "${!INCLUDE_ENV[@]}" | sort
 }
 
 diff_services() {
@@ -58,41 +131,16 @@ make_entry() {
     fi
 
     # Preserve existing cross-service env_file entries from current compose.yaml
-    if [[ -f "$COMPOSE" ]]; then
-        local in_block=false
-        local in_env=false
-        while IFS= read -r line; do
-            # Found our service's include block
-            if [[ "$line" =~ ^[[:space:]]*-[[:space:]]*path:[[:space:]]*services/${svc}/compose\.yaml ]]; then
-                in_block=true; continue
-            fi
-            if ! $in_block; then continue; fi
-
-            # Hit a new service block → stop
-            if [[ "$line" =~ ^[[:space:]]*-[[:space:]]*path: ]]; then
-                break
-            fi
-
-            # Found env_file key
-            if [[ "$line" =~ ^[[:space:]]*env_file: ]]; then
-                in_env=true; continue
-            fi
-            if ! $in_env; then continue; fi
-
-            # env_file list entry (must start with "      - " i.e. 6+ spaces + dash)
-            if [[ "$line" =~ ^[[:space:]]{4,}-[[:space:]]+ ]]; then
-                local env_path
-                env_path=$(echo "$line" | sed 's/^[[:space:]]*-[[:space:]]*//')
-                # Skip .env and the service's own .env (already added above)
-                [[ "$env_path" == ".env" ]] && continue
-                [[ "$env_path" == "services/${svc}/.env" ]] && continue
-                # Cross-service env_file — preserve it
-                entry+=$'\n'"      - ${env_path}"
-            else
-                break  # End of env_file list
-            fi
-        done < "$COMPOSE"
-    fi
+    load_compose
+    local env_path
+    while IFS= read -r env_path; do
+        [[ -z "$env_path" ]] && continue
+        # Skip .env and the service's own .env (already added above)
+        [[ "$env_path" == ".env" ]] && continue
+        [[ "$env_path" == "services/${svc}/.env" ]] && continue
+        # Cross-service env_file — preserve it
+        entry+=$'\n'"      - ${env_path}"
+    done <<< "${INCLUDE_ENV[$svc]:-}"
 
     echo "$entry"
 }
@@ -103,17 +151,24 @@ cmd_check() {
     local disk included missing orphans rc=0
     disk=$(get_disk_services)
     included=$(get_included_services)
+
+    # Both lists are sorted, so equal strings mean equal sets (the common case)
+    if [[ "$disk" == "$included" ]]; then
+        echo "${GREEN}✓${RST} compose.yaml is in sync with services/"
+        return 0
+    fi
+
     missing=$(comm -23 <(echo "$disk") <(echo "$included"))
     orphans=$(comm -13 <(echo "$disk") <(echo "$included"))
 
     if [[ -n "$missing" ]]; then
         echo "${RED}✗${RST} Services on disk but NOT in compose.yaml:" >&2
-        echo "$missing" | sed 's/^/    /' >&2
+        echo "    ${missing//$'\n'/$'\n'    }" >&2
         rc=1
     fi
     if [[ -n "$orphans" ]]; then
         echo "⚠ Services in compose.yaml but NOT on disk:" >&2
-        echo "$orphans" | sed 's/^/    /' >&2
+        echo "    ${orphans//$'\n'/$'\n'    }" >&2
         rc=1
     fi
     if [[ $rc -eq 0 ]]; then
@@ -125,12 +180,14 @@ cmd_check() {
 cmd_sync() {
     local disk
     disk=$(get_disk_services)
+    load_compose
 
     echo "Regenerating compose.yaml with $(echo "$disk" | wc -w) services (sorted alphabetically)..."
 
-    # Extract header (everything before 'include:')
-    local header
-    header=$(sed -n '1,/^include:/p' "$COMPOSE" | head -n -1)
+    # Extract header (everything before 'include:') from the cached lines
+    local header header_len=$INCLUDE_AT
+    (( header_len < 0 )) && header_len=${#COMPOSE_LINES[@]}
+    header=$(printf '%s\n' "${COMPOSE_LINES[@]:0:header_len}")
 
     # Build the new include section
     local includes="include:"
@@ -139,12 +196,14 @@ cmd_sync() {
         includes+=$'\n'"$(make_entry "$svc")"
     done <<< "$disk"
 
-    # Write the new compose.yaml
+    # Write the new compose.yaml via a temp file so an interrupted run
+    # cannot leave it truncated
     {
         echo "$header"
         echo ""
         echo "$includes"
-    } > "$COMPOSE"
+    } > "${COMPOSE}.tmp"
+    mv "${COMPOSE}.tmp" "$COMPOSE"
 
     echo "${GREEN}✓${RST} compose.yaml updated"
 }
@@ -161,36 +220,39 @@ cmd_remove_orphans() {
     fi
 
     echo "Removing orphan entries from compose.yaml:"
+    # Remove every orphan include block in a single pass:
+    #   - path: services/<svc>/compose.yaml
+    #     env_file:          (optional)
+    #       - .env           (optional)
+    #       - services/...   (optional)
+    # and collapse the duplicate blank lines left behind.
+    awk -v orphans="$orphans" '
+    BEGIN {
+        n = split(orphans, list, "\n")
+        for (i = 1; i <= n; i++) if (list[i] != "") drop["services/" list[i] "/compose.yaml"] = 1
+        skip = 0
+    }
+    /^  - path: services\// {
+        if ($3 in drop) {
+            skip = 1
+            next
+        }
+    }
+    skip && /^    / { next }
+    skip && !/^    / { skip = 0 }
+    !skip {
+        if (NF || !prev_blank) print
+        prev_blank = !NF
+    }
+    ' "$COMPOSE" > "${COMPOSE}.tmp"
+    mv "${COMPOSE}.tmp" "$COMPOSE"
+
     while IFS= read -r svc; do
         [[ -z "$svc" ]] && continue
-        # Remove the include block for this service:
-        #   - path: services/<svc>/compose.yaml
-        #     env_file:          (optional)
-        #       - .env           (optional)
-        #       - services/...   (optional)
-        # Use awk to find and skip these lines
-        awk -v svc="$svc" '
-        BEGIN { skip = 0 }
-        /^  - path: services\// {
-            if (index($0, "services/" svc "/compose.yaml")) {
-                skip = 1
-                next
-            }
-        }
-        skip && /^    / { next }
-        skip && !/^    / { skip = 0 }
-        !skip { print }
-        ' "$COMPOSE" > "${COMPOSE}.tmp"
-        mv "${COMPOSE}.tmp" "$COMPOSE"
         echo "  - $svc"
         ((removed++)) || true
     done <<< "$orphans"
 
-    # Clean up empty comment-only sections (lines like "  # --- Added by sync ... ---" with nothing after)
-    # and duplicate blank lines
-    awk 'NF || !prev_blank { print; prev_blank = !NF } NF { prev_blank = 0 }' "$COMPOSE" > "${COMPOSE}.tmp"
-    mv "${COMPOSE}.tmp" "$COMPOSE"
-
     echo "${GREEN}✓${RST} Removed $removed orphan(s)"
 }
 
@@ -208,35 +270,18 @@ cmd_sync_service() {
     fi
 
     # Load environment variables from compose.yaml env_file entries
-    # First, get the env_file entries for this service from compose.yaml
+    # One lookup in the include index answers both "is it included?" and
+    # "which env files does it load?"
     local env_files=()
-    local in_service=false
-    local in_env_file=false
+    local included=false
 
-    while IFS= read -r line; do
-        # Detect our service's include block
-        if [[ "$line" =~ ^\ \ -\ path:\ services/${svc}/compose\.yaml ]]; then
-            in_service=true
-            continue
+    load_compose
+    if [[ -v INCLUDE_ENV["$svc"] ]]; then
+        included=true
+        if [[ -n "${INCLUDE_ENV[$svc]}" ]]; then
+            mapfile -t env_files <<< "${INCLUDE_ENV[$svc]%$'\n'}"
         fi
-        # Detect next service (exit our block)
-        if $in_service && [[ "$line" =~ ^\ \ -\ path: ]]; then
-            break
-        fi
-        # Detect env_file section
-        if $in_service && [[ "$line" =~ ^\ \ \ \ env_file: ]]; then
-            in_env_file=true
-            continue
-        fi
-        # Collect env file entries
-        if $in_service && $in_env_file && [[ "$line" =~ ^\ \ \ \ \ \ -\ (.+)$ ]]; then
-            env_files+=("${BASH_REMATCH[1]}")
-        fi
-        # Exit env_file section if we hit a non-list line
-        if $in_service && $in_env_file && [[ ! "$line" =~ ^\ \ \ \ \ \  ]]; then
-            in_env_file=false
-        fi
-    done < "$COMPOSE"
+    fi
 
     # Load env files in order (compose.yaml entries first, then service-specific)
     for env_file in "${env_files[@]}"; do
@@ -250,7 +295,7 @@ cmd_sync_service() {
     done
 
     # Load service-specific .env if not already in env_files
-    if [[ -f "${svc_dir}/.env" ]] && [[ ! " ${env_files[*]} " =~ " services/${svc}/.env " ]]; then
+    if [[ -f "${svc_dir}/.env" ]] && [[ " ${env_files[*]} " != *" services/${svc}/.env "* ]]; then
         set -a
         # shellcheck source=/dev/null
         source "${svc_dir}/.env"
@@ -265,6 +310,7 @@ cmd_sync_service() {
         [[ "$template" == *".env.template" ]] && continue
 
         local output="${template%.template}"
+        local rel="${template#"$svc_dir"/}"
 
         # Check for unset variables
         local vars_in_template missing_vars=""
@@ -277,7 +323,7 @@ cmd_sync_service() {
         done
 
         if [[ -n "$missing_vars" ]]; then
-            echo "  ${RED}✗${RST} ${template#"$svc_dir"/}"
+            echo "  ${RED}✗${RST} ${rel}"
             echo "    Missing:$missing_vars"
             ((templates_failed++)) || true
             continue
@@ -285,10 +331,10 @@ cmd_sync_service() {
 
         if envsubst < "$template" > "$output" 2>/dev/null; then
             chmod 644 "$output"
-            echo "  ${GREEN}✓${RST} ${template#"$svc_dir"/}"
+            echo "  ${GREEN}✓${RST} ${rel}"
             ((templates_rendered++)) || true
         else
-            echo "  ${RED}✗${RST} ${template#"$svc_dir"/} (envsubst failed)"
+            echo "  ${RED}✗${RST} ${rel} (envsubst failed)"
             ((templates_failed++)) || true
         fi
     done < <(find "$svc_dir" -type f -name "*.template" 2>/dev/null)
@@ -308,7 +354,7 @@ cmd_sync_service() {
     fi
 
     # Check if already in compose.yaml
-    if grep -q "path: services/${svc}/compose.yaml" "$COMPOSE"; then
+    if $included; then
         echo "${GREEN}✓${RST} Service '${svc}' already in compose.yaml"
         return 0
     fi
@@ -323,33 +369,36 @@ cmd_sync_service() {
     local tmpfile="${COMPOSE}.tmp"
     local in_include=false
     local current_service=""
+    local line
 
-    while IFS= read -r line; do
-        # Detect start of include section
-        if [[ "$line" == "include:" ]]; then
-            in_include=true
-            echo "$line" >> "$tmpfile"
-            continue
-        fi
+    # Stream the rewritten file through a single redirection
+    {
+        for line in "${COMPOSE_LINES[@]}"; do
+            # Detect start of include section
+            if [[ "$line" == "include:" ]]; then
+                in_include=true
+                echo "$line"
+                continue
+            fi
 
-        # Detect service path entries
-        if $in_include && [[ "$line" =~ ^\ \ -\ path:\ services/([^/]+)/compose\.yaml$ ]]; then
-            current_service="${BASH_REMATCH[1]}"
-            # Insert before this entry if new service comes first alphabetically
-            if ! $inserted && [[ "$svc" < "$current_service" ]]; then
-                echo "$new_entry" >> "$tmpfile"
-                inserted=true
+            # Detect service path entries (no regex needed once inserted)
+            if $in_include && ! $inserted && [[ "$line" =~ $RE_INCLUDE_ENTRY ]]; then
+                current_service="${BASH_REMATCH[1]}"
+                # Insert before this entry if new service comes first alphabetically
+                if [[ "$svc" < "$current_service" ]]; then
+                    echo "$new_entry"
+                    inserted=true
+                fi
             fi
-        fi
 
-        echo "$line" >> "$tmpfile"
-    done < "$COMPOSE"
+            echo "$line"
+        done
 
-    # If not inserted yet, append at the end of include section
-    if ! $inserted; then
-        # Append new entry at the end
-        echo "$new_entry" >> "$tmpfile"
-    fi
+        # If not inserted yet, append at the end of include section
+        if ! $inserted; then
+            echo "$new_entry"
+        fi
+    } > "$tmpfile"
 
     mv "$tmpfile" "$COMPOSE"
     echo "${GREEN}✓${RST} Added '${svc}' to compose.yaml"